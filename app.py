@@ -13,6 +13,7 @@ from contextlib import contextmanager
 from zoneinfo import ZoneInfo
 
 import streamlit as st
+import numpy as np
 import pandas as pd
 import altair as alt
 import requests
@@ -145,6 +146,13 @@ def _norm(code: str) -> str:
     s = s.lstrip("0")
     return s if s != "" else "0"
 
+def _norm_series(codes: pd.Series) -> pd.Series:
+    """_norm for a whole column at once (pandas string ops, no per-row call).
+    Missing cells stay missing, so they never match a scanned code."""
+    # astype(str) turns NaN into "nan" on older pandas, so put the gaps back
+    normed = codes.astype(str).str.strip().str.lstrip("0").replace("", "0")
+    return normed.where(codes.notna())
+
 def _norm_phone(num: str) -> str:
     return "".join([c for c in str(num).strip() if c.isdigit()])
 
@@ -383,7 +391,7 @@ def determine_next_action(log_df: pd.DataFrame, barcode: str, date_str: str) ->
     norm_b = _norm(barcode)
     today_rows = log_df[
         (log_df["Date"] == date_str) &
-        (log_df["Barcode"].astype(str).apply(_norm) == norm_b)
+        (_norm_series(log_df["Barcode"]) == norm_b)
     ]
     if today_rows.empty:
         return "IN"
@@ -412,7 +420,7 @@ def mark_scan_in_out(barcode: str) -> tuple[bool, str]:
     date_col, date_str, time_str, ts = today_labels()
     ensure_date_column(df, date_col)
 
-    matches = df.index[df["Barcode"].apply(_norm) == _norm(barcode)].tolist()
+    matches = df.index[_norm_series(df["Barcode"]) == _norm(barcode)].tolist()
     if not matches:
         return False, "Barcode not found. Add it to the correct learner in Manage."
 
@@ -457,16 +465,16 @@ def compute_tracking(df: pd.DataFrame) -> pd.DataFrame:
     if not date_cols:
         return pd.DataFrame(columns=["Name","Surname","Barcode","Sessions","Present","Absent","Attendance %","Last present","Grade","Area"])
 
-    present_mat = df[date_cols].applymap(lambda x: 1 if str(x).strip() == "1" else 0)
+    # learners x dates boolean matrix, built column-wise (no per-cell Python calls)
+    present_mat = df[date_cols].astype(str).apply(lambda col: col.str.strip()).eq("1").to_numpy()
     sessions = len(date_cols)
     present_counts = present_mat.sum(axis=1)
     absent_counts = sessions - present_counts
     pct = (present_counts / sessions * 100).round(1)
 
-    last_present = []
-    for _, row in present_mat.iterrows():
-        idxs = [j for j, v in enumerate(row.tolist()) if v == 1]
-        last_present.append(date_cols[max(idxs)] if idxs else "—")
+    # Last True per row = first True scanning the columns right-to-left
+    last_idx = sessions - 1 - present_mat[:, ::-1].argmax(axis=1)
+    last_present = np.where(present_mat.any(axis=1), np.asarray(date_cols, dtype=object)[last_idx], "—")
 
     result = pd.DataFrame({
         "Name": df.get("Name", ""),
@@ -1060,7 +1068,7 @@ with tabs[5]:
             if not name.strip() or not barcode_clean:
                 st.error("Name and Barcode are required.")
             else:
-                exists = df["Barcode"].astype(str).apply(_norm).eq(_norm(barcode_clean)).any()
+                exists = _norm_series(df["Barcode"]).eq(_norm(barcode_clean)).any()
                 if exists:
                     st.error("This barcode already exists. Use the table to edit the existing learner.")
                 else:
@@ -1092,7 +1100,7 @@ with tabs[5]:
                     st.error("Please select a barcode.")
                 else:
                     before = len(df)
-                    df = df[df["Barcode"].astype(str).apply(_norm) != _norm(pick)].copy()
+                    df = df[_norm_series(df["Barcode"]) != _norm(pick)].copy()
                     after = len(df)
                     save_sheet_to_storage(df)
                     st.success(f"Deleted {before - after} record(s) ✅")
@@ -1112,7 +1120,7 @@ with tabs[5]:
                         st.error("Could not read barcode from selection.")
                     else:
                         before = len(df)
-                        df = df[df["Barcode"].astype(str).apply(_norm) != _norm(b)].copy()
+                        df = df[_norm_series(df["Barcode"]) != _norm(b)].copy()
                         after = len(df)
                         save_sheet_to_storage(df)
                         st.success(f"Deleted {before - after} record(s) ✅")
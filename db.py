@@ -1,35 +1,171 @@
 # db.py
+import atexit
 import sqlite3
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 import pandas as pd
 
 # ------------------ UTIL ------------------
 
+# Accepted spellings of the date-of-birth column (lowercase, first match wins)
+DOB_ALIASES = ("date of birth", "date_of_birth", "dob", "birthdate", "birth date")
+
 def norm_barcode(b) -> str:
     """Normalize barcode for matching (strip spaces and leading zeros)."""
     if b is None:
         return ""
+    # Fast path: scanner input is usually already a clean string
+    if type(b) is str and b and b[0] != "0" and not b[0].isspace() and not b[-1].isspace():
+        return b
     s = str(b).strip()
     s = s.lstrip("0")
     return s or "0"
 
-def _connect(db_path: Path):
-    """Connect to SQLite; ensure folder exists."""
-    db_path = Path(db_path)
-    db_path.parent.mkdir(parents=True, exist_ok=True)
-    return sqlite3.connect(str(db_path), check_same_thread=False)
+def _norm_barcode_vec(s: pd.Series) -> pd.Series:
+    """Vectorized norm_barcode for a whole column (same rules, no per-row Python call)."""
+    return s.astype(str).str.strip().str.lstrip("0").replace("", "0")
+
+@lru_cache(maxsize=None)
+def _ensure_parent(db_path: str) -> None:
+    """Create the DB folder once per path (not on every connect)."""
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+# One long-lived connection per DB file, shared by every helper below.
+# Streamlit runs sessions on several threads, so use goes through _db(), and
+# one lock covers all of them: inside this process reads and writes take turns.
+_CONN_CACHE: dict[str, sqlite3.Connection] = {}
+_CONN_LOCK = threading.RLock()
+
+# Per-scan SQL, kept as constants so every call reuses one cached prepared statement
+_INSERT_MARK_SQL = """
+    INSERT OR IGNORE INTO attendance (Barcode, Date_Label, Date_Str, Time_Str, Mark)
+    VALUES (?,?,?,?,'1')
+"""
+_INSERT_LOG_SQL = """
+    INSERT INTO inout_log (ts_iso, date_str, time_str, barcode, name, surname, action)
+    VALUES (?,?,?,?,?,?,?)
+"""
+# A row only replaces the stored one if it is at least as new (ts_iso), so
+# back-dated or out-of-order log rows can't overwrite a later action
+_SET_LAST_ACTION_SQL = """
+    INSERT INTO last_action (barcode, date_str, ts_iso, action) VALUES (?,?,?,?)
+    ON CONFLICT(date_str, barcode) DO UPDATE SET
+        ts_iso = excluded.ts_iso, action = excluded.action
+    WHERE last_action.ts_iso IS NULL OR excluded.ts_iso >= last_action.ts_iso
+"""
+_TOGGLE_LAST_ACTION_SQL = """
+    INSERT INTO last_action (barcode, date_str, ts_iso, action) VALUES (?, ?, ?, 'IN')
+    ON CONFLICT(date_str, barcode) DO UPDATE SET
+        action = CASE WHEN last_action.action = 'IN' THEN 'OUT' ELSE 'IN' END,
+        ts_iso = excluded.ts_iso
+    RETURNING action
+"""
+_GET_LAST_ACTION_SQL = "SELECT action FROM last_action WHERE date_str = ? AND barcode = ?"
+
+def _open(db_path: str) -> sqlite3.Connection:
+    """Open a new connection and apply the PRAGMAs (once per connection)."""
+    _ensure_parent(db_path)
+    # Hot statements below are fixed module-level strings, so the sqlite3
+    # statement cache hands back the prepared VM instead of re-parsing
+    # isolation_level=None: no hidden BEGIN before DML; writers take the
+    # write lock up front in _tx() so other connections never see a half-done scan
+    con = sqlite3.connect(db_path, check_same_thread=False, cached_statements=1024,
+                          isolation_level=None)
+    # Same rules as Python, usable inside SQL (e.g. the one-off migration in _create_schema)
+    con.create_function("norm_barcode", 1, norm_barcode, deterministic=True)
+    # page_size only sticks on a brand-new file (before the first table)
+    if con.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+        con.execute("PRAGMA page_size=8192")
+    # WAL lets other connections (iter_inout_log's reader, other processes)
+    # keep reading while a scan is being written; helpers sharing this
+    # connection still wait on _CONN_LOCK
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA foreign_keys=ON")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-64000")
+    # Read pages through a memory map (256 MB cap) instead of read() calls
+    con.execute("PRAGMA mmap_size=268435456")
+    con.execute("PRAGMA busy_timeout=5000")
+    return con
+
+def _connect(db_path: Path) -> sqlite3.Connection:
+    """Return the shared connection for db_path (opened on first use)."""
+    key = str(db_path)
+    with _CONN_LOCK:
+        con = _CONN_CACHE.get(key)
+        if con is None:
+            con = _CONN_CACHE[key] = _open(key)
+        return con
+
+@contextmanager
+def _db(db_path: Path):
+    """Borrow the shared connection; one thread at a time."""
+    with _CONN_LOCK:
+        yield _connect(db_path)
+
+def _close_all():
+    """At shutdown: refresh any stale planner stats, then close every cached connection."""
+    with _CONN_LOCK:
+        for con in _CONN_CACHE.values():
+            try:
+                con.execute("PRAGMA optimize")
+                con.close()
+            except sqlite3.Error:
+                pass
+        _CONN_CACHE.clear()
+
+atexit.register(_close_all)
+
+# Bumped after every commit made through _tx(); with PRAGMA data_version (which
+# moves when another connection commits) it tells readers whether data changed
+_COMMITS = 0
+
+@contextmanager
+def _tx(db_path: Path):
+    """Borrow the shared connection inside BEGIN IMMEDIATE ... COMMIT (ROLLBACK on error)."""
+    global _COMMITS
+    with _db(db_path) as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+            # Inside the try: a failed COMMIT (deferred FK, SQLITE_BUSY, disk full)
+            # must not leave the shared connection stuck in an open transaction
+            con.execute("COMMIT")
+        except BaseException:
+            # SQLite may already have rolled back on its own; only finish it if
+            # it's still open, so the original error is what propagates
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            # A rolled-back ALTER/CREATE must not linger in the column cache
+            _table_columns_lower.cache_clear()
+            raise
+        _COMMITS += 1
+
+def _fetch_df(con, sql: str, params=(), columns=None) -> pd.DataFrame:
+    """Run a query and build the DataFrame straight from the fetched tuples (no read_sql)."""
+    cur = con.execute(sql, params)
+    rows = cur.fetchall()
+    cols = columns or [d[0] for d in cur.description]
+    return pd.DataFrame.from_records(rows, columns=cols)
 
 def _table_exists(con, table: str) -> bool:
     cur = con.cursor()
     cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
     return cur.fetchone() is not None
 
-def _table_columns_lower(con, table: str) -> set[str]:
-    """Return a set of LOWERCASED column names for a table."""
-    cur = con.cursor()
-    cur.execute(f"PRAGMA table_info({table})")
-    rows = cur.fetchall()
-    return {str(r[1]).strip().lower() for r in rows}
+@lru_cache(maxsize=64)
+def _table_columns_lower(con, table: str) -> frozenset[str]:
+    """
+    Return the LOWERCASED column names for a table.
+    Cached per (connection, table); cleared after any DDL that could change it.
+    """
+    # Table-valued pragma: fixed SQL text with the table bound as a parameter
+    rows = con.execute("SELECT name FROM pragma_table_info(?)", (table,)).fetchall()
+    return frozenset(str(r[0]).strip().lower() for r in rows)
 
 def _safe_add_column(con, table: str, column_def: str):
     """
@@ -41,6 +177,7 @@ def _safe_add_column(con, table: str, column_def: str):
     except Exception:
         # Ignore any error here (duplicate column, locked DB, etc.)
         pass
+    _table_columns_lower.cache_clear()
 
 def _ensure_learners_schema(con):
     """
@@ -72,7 +209,6 @@ def _normalize_learner_columns(df: pd.DataFrame) -> pd.DataFrame:
     if df is None or df.empty:
         return pd.DataFrame(columns=required)
 
-    df = df.copy()
     lower_map = {str(c).lower().strip(): c for c in df.columns}
 
     def pick(*candidates):
@@ -99,32 +235,45 @@ def _normalize_learner_columns(df: pd.DataFrame) -> pd.DataFrame:
     c = pick("area")
     if c: rename[c] = "Area"
 
-    # DOB variants
-    c = pick("date of birth", "date_of_birth", "dob", "birthdate", "birth date", "date_of_birth ")
+    # DOB variants (also covers the DB's own Date_Of_Birth column)
+    c = pick(*DOB_ALIASES)
     if c: rename[c] = "Date Of Birth"
 
-    # DB uses Date_Of_Birth
-    if "Date_Of_Birth" in df.columns:
-        rename["Date_Of_Birth"] = "Date Of Birth"
-
     if rename:
         df = df.rename(columns=rename)
 
-    for c in required:
-        if c not in df.columns:
-            df[c] = ""
-
+    # New frame with just the learner columns (missing ones as ""), so the
+    # string pass below never touches extra columns such as date marks
+    df = df.reindex(columns=required, fill_value="")
     df = df.fillna("").astype(str)
-    df["Barcode"] = df["Barcode"].apply(norm_barcode)
+    df["Barcode"] = _norm_barcode_vec(df["Barcode"])
 
-    return df[required]
+    return df
 
 
 # ------------------ INIT DB ------------------
 
-def init_db(db_path: Path):
-    """Create required tables if they don't exist (does NOT delete data)."""
-    con = _connect(db_path)
+# Small tables looked up only by their primary key. Stored WITHOUT ROWID so
+# each is a single b-tree (no separate rowid table + PK index).
+_KEYED_TABLES = {
+    "auto_send_log": "send_date TEXT PRIMARY KEY, sent_at TEXT",
+    "auto_send_recipient_log": "send_date TEXT, phone TEXT, sent_at TEXT, PRIMARY KEY (send_date, phone)",
+}
+
+# last_action: latest IN/OUT action per learner per date, i.e. the newest inout_log
+# row (by ts_iso) for each (date_str, barcode), so a scan never searches inout_log.
+# Not one of the keyed tables above: it is only ever built from inout_log, by init_db
+_LAST_ACTION_COLS = (
+    "barcode TEXT NOT NULL, date_str TEXT NOT NULL, ts_iso TEXT, action TEXT, "
+    "PRIMARY KEY (date_str, barcode)"
+)
+
+def _create_keyed_tables(con):
+    for table, cols in _KEYED_TABLES.items():
+        con.execute(f"CREATE TABLE IF NOT EXISTS {table} ({cols}) WITHOUT ROWID")
+
+def _create_schema(con):
+    """Tables, one-off migrations and indexes (all IF NOT EXISTS)."""
     cur = con.cursor()
 
     cur.execute("""
@@ -143,12 +292,13 @@ def init_db(db_path: Path):
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS attendance (
-        Barcode TEXT,
-        Date_Label TEXT,
+        Barcode TEXT NOT NULL,
+        Date_Label TEXT NOT NULL,
         Date_Str TEXT,
         Time_Str TEXT,
-        Mark TEXT
-    )
+        Mark TEXT,
+        PRIMARY KEY (Barcode, Date_Label)
+    ) WITHOUT ROWID
     """)
 
     cur.execute("""
@@ -163,33 +313,177 @@ def init_db(db_path: Path):
     )
     """)
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS auto_send_log (
-        send_date TEXT PRIMARY KEY,
-        sent_at TEXT
-    )
-    """)
+    _create_keyed_tables(con)
+
+    # Schema version 1: every stored barcode is normalized, so reads and joins
+    # can compare them as-is. Rows from older code are fixed once, in SQL, before
+    # the attendance rebuild and the last_action backfill below read them.
+    # If "007" and "7" collide, the row already stored as "7" is kept
+    # (UPDATE OR IGNORE) and the unnormalized leftover is deleted.
+    cur.execute("PRAGMA user_version")
+    version = cur.fetchone()[0]
+    if version < 1:
+        cur.execute("UPDATE inout_log SET barcode = norm_barcode(barcode) WHERE barcode IS NOT norm_barcode(barcode)")
+        for table in ("learners", "attendance"):
+            stale = "Barcode IS NOT norm_barcode(Barcode)"
+            cur.execute(f"UPDATE OR IGNORE {table} SET Barcode = norm_barcode(Barcode) WHERE {stale}")
+            cur.execute(f"DELETE FROM {table} WHERE {stale}")
+        cur.execute("PRAGMA user_version = 1")
+
+    # Indexes for the per-scan lookups (currently IN, wide sheet).
+    # "Currently IN" filters one date and partitions by barcode, newest first,
+    # which (date_str, barcode, ts_iso DESC) serves directly.
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_inout_date_barcode_ts'")
+    new_inout_index = cur.fetchone() is None
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_inout_date_barcode_ts ON inout_log(date_str, barcode, ts_iso DESC)")
+    # One mark per learner per date: (Barcode, Date_Label) is the primary key of a
+    # WITHOUT ROWID table, so double scans are ignored at insert time and the
+    # wide-sheet join (by Barcode) reads everything from that one b-tree.
+    # Older DBs have a plain rowid table with no key: rebuild once, keeping the
+    # first mark of any duplicates.
+    cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='attendance'")
+    rebuilt_attendance = "WITHOUT ROWID" not in cur.fetchone()[0].upper()
+    if rebuilt_attendance:
+        cur.execute("""
+            CREATE TABLE attendance__new (
+                Barcode TEXT NOT NULL,
+                Date_Label TEXT NOT NULL,
+                Date_Str TEXT,
+                Time_Str TEXT,
+                Mark TEXT,
+                PRIMARY KEY (Barcode, Date_Label)
+            ) WITHOUT ROWID
+        """)
+        cur.execute("""
+            INSERT OR IGNORE INTO attendance__new (Barcode, Date_Label, Date_Str, Time_Str, Mark)
+            SELECT Barcode, Date_Label, Date_Str, Time_Str, Mark FROM attendance ORDER BY rowid
+        """)
+        cur.execute("DROP TABLE attendance")  # takes the old indexes with it
+        cur.execute("ALTER TABLE attendance__new RENAME TO attendance")
+    # Covers the date-column list: labels in calendar order via MIN(Date_Str)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_att_label_date ON attendance(Date_Label, Date_Str)")
+
+    # Schema version 2: the small keyed tables are WITHOUT ROWID (one b-tree each)
+    if version < 2:
+        for table, cols in _KEYED_TABLES.items():
+            cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
+            if "WITHOUT ROWID" not in cur.fetchone()[0].upper():
+                cur.execute(f"CREATE TABLE {table}__new ({cols}) WITHOUT ROWID")
+                cur.execute(f"INSERT OR IGNORE INTO {table}__new SELECT * FROM {table}")
+                cur.execute(f"DROP TABLE {table}")
+                cur.execute(f"ALTER TABLE {table}__new RENAME TO {table}")
+        cur.execute("PRAGMA user_version = 2")
+
+    # Schema version 3: last_action is (re)built from the log once. Whether it
+    # exists says nothing about its contents (older code could create it empty),
+    # so the version decides; version 1 has already normalized the log barcodes
+    if version < 3:
+        cur.execute("DROP TABLE IF EXISTS last_action")
+        cur.execute(f"CREATE TABLE last_action ({_LAST_ACTION_COLS}) WITHOUT ROWID")
+        cur.execute("""
+            INSERT INTO last_action (barcode, date_str, ts_iso, action)
+            SELECT barcode, date_str, ts_iso, action FROM (
+                SELECT barcode, date_str, ts_iso, action,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY date_str, barcode ORDER BY ts_iso DESC, rowid DESC
+                       ) AS rn
+                FROM inout_log
+                WHERE barcode IS NOT NULL AND date_str IS NOT NULL
+            )
+            WHERE rn = 1
+        """)
+        cur.execute("PRAGMA user_version = 3")
+
+    if new_inout_index or rebuilt_attendance:
+        # Give the planner real stats for the new indexes straight away
+        cur.execute("ANALYZE")
+
+# DB paths whose schema this process has already set up (the schema is static
+# while the app runs, so Streamlit reruns skip the DDL)
+_INITIALIZED: set[str] = set()
 
-    con.commit()
-    con.close()
+def init_db(db_path: Path):
+    """Create required tables if they don't exist (does NOT delete data)."""
+    key = str(db_path)
+    with _CONN_LOCK:
+        if key in _INITIALIZED:
+            return
+        with _tx(db_path) as con:
+            _create_schema(con)
+        _table_columns_lower.cache_clear()
+        with _db(db_path) as con:
+            # Refresh planner stats for any table/index that needs it (cheap no-op otherwise)
+            con.execute("PRAGMA optimize")
+        _INITIALIZED.add(key)
 
 
 # ------------------ LEARNERS ------------------
+
+# Bumped on every learner write made through this module; part of the learner cache key.
+# Separate from _COMMITS so that scans (which commit too) don't evict the learner cache.
+_LEARNERS_VERSION = 0
+
+def _learners_changed():
+    """
+    Call inside the write's _tx block: the bump then happens under _CONN_LOCK,
+    so no reader can cache the old rows under the new version.
+    """
+    global _LEARNERS_VERSION
+    _LEARNERS_VERSION += 1
+
+def _learners_version(db_path: Path) -> tuple[int, int]:
+    """Learner cache key: writes made here plus commits by other connections (PRAGMA data_version)."""
+    with _db(db_path) as con:
+        return _LEARNERS_VERSION, con.execute("PRAGMA data_version").fetchone()[0]
+
+@lru_cache(maxsize=4)
+def _learners_df_cached(db_path: str, version: tuple[int, int]) -> pd.DataFrame:
+    with _db(db_path) as con:
+        # Older files may still lack Area/Date_Of_Birth; add them before naming them
+        _ensure_learners_schema(con)
+        # Strings with '' for NULL straight from SQL: no fillna/astype pass afterwards
+        df = _fetch_df(con, """
+            SELECT IFNULL(CAST(Barcode AS TEXT), '') AS Barcode,
+                   IFNULL(CAST(Name AS TEXT), '') AS Name,
+                   IFNULL(CAST(Surname AS TEXT), '') AS Surname,
+                   IFNULL(CAST(Grade AS TEXT), '') AS Grade,
+                   IFNULL(CAST(Area AS TEXT), '') AS Area,
+                   IFNULL(CAST(Date_Of_Birth AS TEXT), '') AS "Date Of Birth"
+            FROM learners
+        """)
+
+    # Barcodes are stored normalized (schema version 1), nothing left to do per row
+    return df
+
 def get_learners_df(db_path: Path) -> pd.DataFrame:
-    con = _connect(db_path)
-    try:
-        df = pd.read_sql("SELECT * FROM learners", con)
-    finally:
-        con.close()
+    # Copy so callers can't mutate the cached frame
+    return _learners_df_cached(str(db_path), _learners_version(db_path)).copy()
 
-    if df.empty:
-        return pd.DataFrame(columns=["Barcode","Name","Surname","Grade","Area","Date Of Birth"])
+@lru_cache(maxsize=4)
+def _learners_by_barcode(db_path: str, version: tuple[int, int]) -> dict[str, dict]:
+    """{barcode: learner row} built once per learners version (same key as the frame cache)."""
+    df = _learners_df_cached(db_path, version)
+    return {r["Barcode"]: r for r in df.to_dict("records")}
 
-    if "Date_Of_Birth" in df.columns and "Date Of Birth" not in df.columns:
-        df = df.rename(columns={"Date_Of_Birth": "Date Of Birth"})
+def get_learner_by_barcode(db_path: Path, barcode: str) -> dict | None:
+    """
+    Learner row (Barcode, Name, Surname, Grade, Area, Date Of Birth) for a scan, or None.
+    A dict lookup on the scan path; any learner write (here or from another
+    connection) changes the version and rebuilds it.
+    """
+    row = _learners_by_barcode(str(db_path), _learners_version(db_path)).get(norm_barcode(barcode))
+    return dict(row) if row is not None else None
 
-    return _normalize_learner_columns(df)
 
+# Update in place on a known barcode: unlike INSERT OR REPLACE this keeps the
+# row's rowid, so an edited learner keeps their place in the sheet
+_UPSERT_LEARNER_SQL = """
+    INSERT INTO learners (Barcode, Name, Surname, Grade, Area, Date_Of_Birth)
+    VALUES (?,?,?,?,?,?)
+    ON CONFLICT(Barcode) DO UPDATE SET
+        Name = excluded.Name, Surname = excluded.Surname, Grade = excluded.Grade,
+        Area = excluded.Area, Date_Of_Birth = excluded.Date_Of_Birth
+"""
 
 def replace_learners_from_df(db_path: Path, df: pd.DataFrame):
     """
@@ -197,34 +491,20 @@ def replace_learners_from_df(db_path: Path, df: pd.DataFrame):
     Note: This does NOT delete attendance table. It only replaces learners table.
     """
     df = _normalize_learner_columns(df)
+    cols = ["Barcode", "Name", "Surname", "Grade", "Area", "Date Of Birth"]
+    for c in cols[1:]:
+        df[c] = df[c].str.strip()
 
-    con = _connect(db_path)
-    cur = con.cursor()
-
-    _ensure_learners_schema(con)
-
-    cur.execute("DELETE FROM learners")
+    # Skip blank barcodes; the upsert keeps the last duplicate's values, as before
+    rows = [r for r in df[cols].itertuples(index=False, name=None) if r[0].strip()]
 
-    for _, r in df.iterrows():
-        bc = norm_barcode(r.get("Barcode", ""))
-        if not bc.strip():
-            continue
-
-        cur.execute("""
-            INSERT OR REPLACE INTO learners
-            (Barcode, Name, Surname, Grade, Area, Date_Of_Birth)
-            VALUES (?,?,?,?,?,?)
-        """, (
-            bc,
-            str(r.get("Name", "")).strip(),
-            str(r.get("Surname", "")).strip(),
-            str(r.get("Grade", "")).strip(),
-            str(r.get("Area", "")).strip(),
-            str(r.get("Date Of Birth", "")).strip(),
-        ))
-
-    con.commit()
-    con.close()
+    with _tx(db_path) as con:
+        _ensure_learners_schema(con)
+        con.execute("DELETE FROM learners")
+        con.executemany(_UPSERT_LEARNER_SQL, rows)
+        # Whole table rewritten (also the CSV seed path): fresh stats for the planner
+        con.execute("ANALYZE learners")
+        _learners_changed()
 
 def add_or_update_learner(db_path: Path, barcode: str, name: str, surname: str,
                           grade: str = "", area: str = "", dob: str = "") -> None:
@@ -233,36 +513,30 @@ def add_or_update_learner(db_path: Path, barcode: str, name: str, surname: str,
     if not bc.strip():
         return
 
-    con = _connect(db_path)
-    cur = con.cursor()
-
-    _ensure_learners_schema(con)
+    with _db(db_path) as con:
+        _ensure_learners_schema(con)
+    add_or_update_learner_tuple(
+        db_path, bc, str(name).strip(), str(surname).strip(),
+        str(grade).strip(), str(area).strip(), str(dob).strip(),
+    )
 
-    cur.execute("""
-        INSERT OR REPLACE INTO learners
-        (Barcode, Name, Surname, Grade, Area, Date_Of_Birth)
-        VALUES (?,?,?,?,?,?)
-    """, (
-        bc,
-        str(name).strip(),
-        str(surname).strip(),
-        str(grade).strip(),
-        str(area).strip(),
-        str(dob).strip()
-    ))
-
-    con.commit()
-    con.close()
+def add_or_update_learner_tuple(db_path: Path, barcode: str, name: str, surname: str,
+                                grade: str, area: str, dob: str) -> None:
+    """
+    Fast path of add_or_update_learner: values must already be clean strings
+    (barcode normalized, fields stripped) and the schema set up by init_db.
+    One bind + step on a cached statement.
+    """
+    with _tx(db_path) as con:
+        con.execute(_UPSERT_LEARNER_SQL, (barcode, name, surname, grade, area, dob))
+        _learners_changed()
 
 def delete_learner_by_barcode(db_path: Path, barcode: str) -> int:
     """Delete learner by barcode. Returns number deleted."""
-    con = _connect(db_path)
-    cur = con.cursor()
     nb = norm_barcode(barcode)
-    cur.execute("DELETE FROM learners WHERE Barcode = ?", (nb,))
-    count = cur.rowcount
-    con.commit()
-    con.close()
+    with _tx(db_path) as con:
+        count = con.execute("DELETE FROM learners WHERE Barcode = ?", (nb,)).rowcount
+        _learners_changed()
     return count
 
 
@@ -272,130 +546,387 @@ def add_class_date(db_path: Path, date_label: str):
     """No-op: dates appear when attendance rows exist."""
     return
 
+def get_all_class_dates(db_path: Path) -> list[str]:
+    """
+    Distinct Date_Labels that have marks, in calendar order.
+    Labels like "3-Jan" don't sort as text, so order by the ISO Date_Str
+    stored with each mark (covered by idx_att_label_date).
+    """
+    with _db(db_path) as con:
+        rows = con.execute("""
+            SELECT Date_Label FROM attendance
+            GROUP BY Date_Label
+            ORDER BY MIN(Date_Str), Date_Label
+        """).fetchall()
+    return [r[0] for r in rows]
+
 def insert_present_mark(db_path: Path, date_label: str, date_str: str, time_str: str, barcode: str):
     """Insert attendance mark '1' for a barcode and a date label."""
-    con = _connect(db_path)
-    cur = con.cursor()
-    cur.execute("""
-        INSERT INTO attendance (Barcode, Date_Label, Date_Str, Time_Str, Mark)
-        VALUES (?,?,?,?,?)
-    """, (norm_barcode(barcode), str(date_label), str(date_str), str(time_str), "1"))
-    con.commit()
-    con.close()
+    insert_present_marks_bulk(db_path, [(date_label, date_str, time_str, barcode)])
 
-def get_wide_sheet(db_path: Path) -> pd.DataFrame:
+def insert_present_marks_bulk(db_path: Path, rows):
     """
-    Join learners with attendance pivot (wide format).
+    Insert attendance mark '1' for many learners in one transaction.
+    rows: iterable of (date_label, date_str, time_str, barcode)
     """
-    learners = get_learners_df(db_path)
-    if learners.empty:
-        return learners
+    params = [
+        (norm_barcode(bc), str(label), str(d), str(t))
+        for label, d, t, bc in rows
+    ]
+    if not params:
+        return
 
-    con = _connect(db_path)
-    try:
-        att = pd.read_sql("SELECT * FROM attendance", con)
-    finally:
-        con.close()
+    with _tx(db_path) as con:
+        con.executemany(_INSERT_MARK_SQL, params)
 
-    if att.empty:
-        return learners.fillna("")
+def _wide_sheet_sql(labels: list[str]) -> str:
+    """
+    One query for the whole wide sheet: every learner (in insert order) plus
+    one column per Date_Label holding "1" when marked present.
+    Labels are bound as parameters; only the column aliases are quoted in.
+    """
+    def mark_col(label: str) -> str:
+        alias = '"' + label.replace('"', '""') + '"'
+        return f",\n    IFNULL(MAX(CASE WHEN a.Date_Label = ? THEN a.Mark END), '') AS {alias}"
+
+    cols = "".join(mark_col(label) for label in labels)
+    join = "LEFT JOIN attendance a ON a.Barcode = l.Barcode" if labels else ""
+    return f"""
+        SELECT IFNULL(CAST(l.Barcode AS TEXT), '') AS Barcode,
+            IFNULL(CAST(l.Name AS TEXT), '') AS Name,
+            IFNULL(CAST(l.Surname AS TEXT), '') AS Surname,
+            IFNULL(CAST(l.Grade AS TEXT), '') AS Grade,
+            IFNULL(CAST(l.Area AS TEXT), '') AS Area,
+            IFNULL(CAST(l.Date_Of_Birth AS TEXT), '') AS "Date Of Birth"{cols}
+        FROM learners l
+        {join}
+        GROUP BY l.rowid
+        ORDER BY l.rowid
+    """
 
-    att = att.fillna("").astype(str)
+# {db_path: (data token, frame)}: Streamlit reruns reuse the last pivot until a write
+_WIDE_CACHE: dict[str, tuple[tuple[int, int], pd.DataFrame]] = {}
 
-    if "Barcode" in att.columns:
-        att["Barcode"] = att["Barcode"].apply(norm_barcode)
+def get_wide_sheet(db_path: Path) -> pd.DataFrame:
+    """
+    Join learners with attendance pivot (wide format).
+    """
+    key = str(db_path)
+    with _db(db_path) as con:
+        token = (_COMMITS, con.execute("PRAGMA data_version").fetchone()[0])
+        cached = _WIDE_CACHE.get(key)
+        if cached is not None and cached[0] == token:
+            # Copy so callers can't mutate the cached frame
+            return cached[1].copy()
 
-    wide = att.pivot_table(
-        index="Barcode",
-        columns="Date_Label",
-        values="Mark",
-        aggfunc="last"
-    ).reset_index()
+        labels = get_all_class_dates(db_path)
+        sql = _wide_sheet_sql(labels)
+        # Pivot and join both run inside SQLite (conditional aggregation);
+        # barcodes on both tables are normalized on write, so they join as-is
+        # Every column comes back as text with '' for blanks, so no fillna pass
+        df = _fetch_df(con, sql, labels)
+        _WIDE_CACHE[key] = (token, df)
 
-    df = learners.merge(wide, on="Barcode", how="left")
-    return df.fillna("")
+    return df.copy()
 
 
 # ------------------ IN / OUT LOGIC ------------------
 
+# In-process copy of last_action for one date per DB: {(db, date_str): {barcode: action}}
+# SQLite stays the source of truth; this only saves the per-scan read.
+_status: dict[tuple[str, str], dict[str, str]] = {}
+_status_lock = threading.Lock()
+
+def _status_for(db_path: Path, date_str: str) -> dict[str, str]:
+    """Return the cached {barcode: action} map for a date, loading it once."""
+    key = (str(db_path), str(date_str))
+    with _status_lock:
+        status = _status.get(key)
+    if status is not None:
+        return status
+
+    # Load and publish while still holding _CONN_LOCK: writers update the map
+    # under the same lock, so none can commit in between and be missed
+    with _db(db_path) as con:
+        rows = con.execute(
+            "SELECT barcode, action FROM last_action WHERE date_str = ?", (str(date_str),)
+        ).fetchall()
+
+        with _status_lock:
+            status = _status.get(key)
+            if status is None:
+                # Date rollover: drop the older dates cached for this DB
+                for k in [k for k in _status if k[0] == key[0]]:
+                    del _status[k]
+                status = _status[key] = dict(rows)
+    return status
+
+def _remember_action(db_path: Path, date_str: str, barcode: str, action: str):
+    """
+    Update the in-process status after a committed IN/OUT write.
+    Call it while still holding _CONN_LOCK (right after the _tx block), so it
+    can't interleave with a _status_for load or with another writer.
+    """
+    key = (str(db_path), str(date_str))
+    with _status_lock:
+        status = _status.get(key)
+        if status is not None:
+            status[barcode] = action
+
+def _last_action(con, barcode: str, date_str: str) -> str | None:
+    row = con.execute(_GET_LAST_ACTION_SQL, (str(date_str), barcode)).fetchone()
+    return row[0] if row is not None else None
+
+def _set_last_action(con, barcode: str, date_str: str, ts_iso: str, action: str) -> str:
+    """
+    Keep the last_action cache in step with an inout_log insert.
+    Returns the action now stored, which stays the newer one if this row is older.
+    """
+    con.execute(_SET_LAST_ACTION_SQL, (barcode, str(date_str), ts_iso, str(action)))
+    return _last_action(con, barcode, date_str)
+
 def append_inout_log(db_path: Path, ts_iso: str, date_str: str, time_str: str,
                      barcode: str, name: str, surname: str, action: str):
-    con = _connect(db_path)
-    cur = con.cursor()
-    cur.execute("""
-        INSERT INTO inout_log (ts_iso, date_str, time_str, barcode, name, surname, action)
-        VALUES (?,?,?,?,?,?,?)
-    """, (ts_iso, date_str, time_str, norm_barcode(barcode), name, surname, action))
-    con.commit()
-    con.close()
+    bc = norm_barcode(barcode)
+    with _CONN_LOCK:
+        with _tx(db_path) as con:
+            con.execute(_INSERT_LOG_SQL, (ts_iso, date_str, time_str, bc, name, surname, action))
+            latest = _set_last_action(con, bc, date_str, ts_iso, action)
+        _remember_action(db_path, date_str, bc, latest)
 
 def determine_next_action(db_path: Path, barcode: str, date_str: str) -> str:
     """Toggle IN/OUT for the same learner on the same date."""
-    con = _connect(db_path)
+    last = _status_for(db_path, date_str).get(norm_barcode(barcode))
+    return "OUT" if last == "IN" else "IN"
+
+def _log_scan(con, ts_iso: str, date_str: str, time_str: str,
+              bc: str, name: str, surname: str) -> str:
+    """Toggle last_action for bc and append the inout_log row (caller owns the transaction)."""
     cur = con.cursor()
-    cur.execute("""
-        SELECT action FROM inout_log
-        WHERE barcode = ? AND date_str = ?
-        ORDER BY ts_iso DESC LIMIT 1
-    """, (norm_barcode(barcode), str(date_str)))
-    row = cur.fetchone()
-    con.close()
 
-    if row is None:
-        return "IN"
-    return "OUT" if row[0] == "IN" else "IN"
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        # One statement: toggle the cached action and hand it back
+        cur.execute(_TOGGLE_LAST_ACTION_SQL, (bc, str(date_str), ts_iso))
+        action = cur.fetchone()[0]
+    else:
+        # Older SQLite (no RETURNING): read then write; _tx already holds the write lock
+        action = "OUT" if _last_action(con, bc, date_str) == "IN" else "IN"
+        _set_last_action(con, bc, date_str, ts_iso, action)
+
+    cur.execute(_INSERT_LOG_SQL, (ts_iso, date_str, time_str, bc, name, surname, action))
+    return action
+
+def record_scan_action(db_path: Path, ts_iso: str, date_str: str, time_str: str,
+                       barcode: str, name: str, surname: str) -> str:
+    """
+    Work out the next IN/OUT action for a scan AND log it, in one transaction.
+    Returns the action that was recorded ("IN" or "OUT").
+    """
+    bc = norm_barcode(barcode)
+    with _CONN_LOCK:
+        with _tx(db_path) as con:
+            action = _log_scan(con, ts_iso, date_str, time_str, bc, name, surname)
+        _remember_action(db_path, date_str, bc, action)
+    return action
+
+def record_scan(db_path: Path, ts_iso: str, date_label: str, date_str: str, time_str: str,
+                barcode: str, name: str, surname: str) -> str:
+    """
+    Full kiosk scan: present mark + IN/OUT toggle + log row, one commit.
+    Returns the action that was recorded ("IN" or "OUT").
+    """
+    bc = norm_barcode(barcode)
+    with _CONN_LOCK:
+        with _tx(db_path) as con:
+            con.execute(_INSERT_MARK_SQL, (bc, str(date_label), str(date_str), str(time_str)))
+            action = _log_scan(con, ts_iso, date_str, time_str, bc, name, surname)
+        _remember_action(db_path, date_str, bc, action)
+    return action
+
+class ScanBatcher:
+    """
+    Group-commit scans: buffer them in memory and write every `every` scans,
+    at most `max_delay` seconds after the first buffered scan (a background
+    timer flushes even if no further scan arrives), or on close. Use as a
+    context manager:
+
+        with ScanBatcher(DB_PATH) as batch:
+            action = batch.add(ts_iso, date_label, date_str, time_str, barcode, name, surname)
+
+    A batcher that is never closed is still flushed at normal interpreter exit
+    (atexit); buffered scans are only lost if the process is killed or crashes
+    before a flush. every=1 gives the same durability as record_scan. While scans are buffered, only this
+    batcher knows their IN/OUT state, so don't mix it with record_scan on the
+    same DB and date.
+    """
+
+    def __init__(self, db_path: Path, every: int = 20, max_delay: float = 2.0):
+        self.db_path = db_path
+        self.every = max(1, int(every))
+        self.max_delay = max_delay
+        self._marks = []
+        self._logs = []
+        self._pending = {}  # {(date_str, barcode): action} not yet flushed
+        self._timer = None
+        # add() and the timer's flush() run on different threads; take this
+        # before _CONN_LOCK, never the other way round
+        self._lock = threading.RLock()
+        # Runs before _close_all (atexit is last in, first out); close() unregisters
+        atexit.register(self.flush)
+
+    def add(self, ts_iso: str, date_label: str, date_str: str, time_str: str,
+            barcode: str, name: str, surname: str) -> str:
+        """Buffer one scan and return its IN/OUT action."""
+        bc = norm_barcode(barcode)
+        key = (str(date_str), bc)
+        with self._lock:
+            last = self._pending.get(key)
+            if last is None:
+                last = _status_for(self.db_path, date_str).get(bc)
+            action = "OUT" if last == "IN" else "IN"
+
+            self._pending[key] = action
+            self._marks.append((bc, str(date_label), str(date_str), str(time_str)))
+            self._logs.append((ts_iso, date_str, time_str, bc, name, surname, action))
+
+            if len(self._logs) >= self.every or self.max_delay <= 0:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return action
+
+    def flush(self):
+        """Write everything buffered in one transaction."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._logs:
+                return
+            with _CONN_LOCK:
+                with _tx(self.db_path) as con:
+                    con.executemany(_INSERT_MARK_SQL, self._marks)
+                    con.executemany(_INSERT_LOG_SQL, self._logs)
+                    # Row by row in log order; the ts_iso guard keeps the newest
+                    con.executemany(
+                        _SET_LAST_ACTION_SQL,
+                        [(bc, d, ts, action) for ts, d, _, bc, _, _, action in self._logs],
+                    )
+                    latest = {(d, bc): _last_action(con, bc, d) for d, bc in self._pending}
+                for (d, bc), action in latest.items():
+                    _remember_action(self.db_path, d, bc, action)
+            self._marks, self._logs, self._pending = [], [], {}
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def get_currently_in_rows(db_path: Path, date_str: str) -> list[dict]:
+    """Learners currently IN for a date, as plain dicts (Barcode, Name, Surname)."""
+    with _db(db_path) as con:
+        # An IN row counts only if it is that learner's latest row for the day.
+        # The inner lookup is a covering seek on idx_inout_date_barcode_ts.
+        rows = con.execute("""
+            SELECT i.barcode, i.name, i.surname
+            FROM inout_log i
+            WHERE i.date_str = ? AND i.action = 'IN' AND i.rowid = (
+                SELECT j.rowid FROM inout_log j
+                WHERE j.date_str = i.date_str AND j.barcode = i.barcode
+                ORDER BY j.ts_iso DESC, j.rowid DESC
+                LIMIT 1
+            )
+            ORDER BY i.ts_iso
+        """, (str(date_str),)).fetchall()
+
+    return [{"Barcode": b, "Name": n, "Surname": s} for b, n, s in rows]
 
 def get_currently_in(db_path: Path, date_str: str) -> pd.DataFrame:
     """Return learners who are currently IN for a given date."""
-    con = _connect(db_path)
+    return pd.DataFrame(get_currently_in_rows(db_path, date_str),
+                        columns=["Barcode", "Name", "Surname"])
+
+_INOUT_LOG_COLUMNS = ["Timestamp", "Date", "Time", "Barcode", "Name", "Surname", "Action"]
+_INOUT_LOG_SQL = """
+    SELECT ts_iso, date_str, time_str, barcode, name, surname, action
+    FROM inout_log
+    ORDER BY ts_iso, rowid
+"""
+
+def get_inout_log(db_path: Path) -> pd.DataFrame:
+    """Full IN/OUT log, oldest first (same columns as the app's attendance_log.csv)."""
+    with _db(db_path) as con:
+        return _fetch_df(con, _INOUT_LOG_SQL, columns=_INOUT_LOG_COLUMNS)
+
+def iter_inout_log(db_path: Path, chunksize: int = 10000) -> Iterator[pd.DataFrame]:
+    """
+    Same rows as get_inout_log, yielded as DataFrames of at most `chunksize` rows,
+    so exports of a long log never hold it all in memory.
+    Reads through its own connection (one WAL snapshot), so scans keep writing
+    on the shared connection while the export runs.
+    """
+    _ensure_parent(str(db_path))
+    con = sqlite3.connect(str(db_path), isolation_level=None)
     try:
-        df = pd.read_sql("""
-            SELECT * FROM inout_log
-            WHERE date_str = ?
-            ORDER BY ts_iso
-        """, con, params=(str(date_str),))
+        con.execute("PRAGMA busy_timeout=5000")
+        con.execute("BEGIN")
+        cur = con.execute(_INOUT_LOG_SQL)
+        while rows := cur.fetchmany(chunksize):
+            yield pd.DataFrame.from_records(rows, columns=_INOUT_LOG_COLUMNS)
     finally:
         con.close()
 
-    if df.empty:
-        return df
-
-    latest = df.sort_values("ts_iso").groupby("barcode").tail(1)
-    current = latest[latest["action"] == "IN"][["barcode", "name", "surname"]].copy()
-    return current.rename(columns={"barcode": "Barcode", "name": "Name", "surname": "Surname"})
-
 
 # ------------------ AUTO SEND ------------------
 
 def ensure_auto_send_table(db_path: Path):
-    con = _connect(db_path)
-    cur = con.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS auto_send_log (
-            send_date TEXT PRIMARY KEY,
-            sent_at TEXT
-        )
-    """)
-    con.commit()
-    con.close()
+    if str(db_path) in _INITIALIZED:
+        return  # init_db already created them
+    with _tx(db_path) as con:
+        _create_keyed_tables(con)
 
 def already_sent_today(db_path: Path, date_str: str) -> bool:
-    con = _connect(db_path)
-    cur = con.cursor()
-    cur.execute("SELECT 1 FROM auto_send_log WHERE send_date = ?", (str(date_str),))
-    row = cur.fetchone()
-    con.close()
+    with _db(db_path) as con:
+        row = con.execute("SELECT 1 FROM auto_send_log WHERE send_date = ?", (str(date_str),)).fetchone()
     return bool(row)
 
 def mark_sent_today(db_path: Path, date_str: str, ts_iso: str):
-    con = _connect(db_path)
-    cur = con.cursor()
-    cur.execute(
-        "INSERT OR REPLACE INTO auto_send_log(send_date, sent_at) VALUES (?, ?)",
-        (str(date_str), str(ts_iso)),
-    )
-    con.commit()
-    con.close()
+    with _tx(db_path) as con:
+        con.execute(
+            "INSERT OR REPLACE INTO auto_send_log(send_date, sent_at) VALUES (?, ?)",
+            (str(date_str), str(ts_iso)),
+        )
+
+def already_sent_today_for_recipients(db_path: Path, date_str: str, phones) -> set[str]:
+    """Return the subset of phones already messaged on date_str (one query)."""
+    phones = [str(p).strip() for p in phones if str(p).strip()]
+    if not phones:
+        return set()
+    marks = ",".join("?" * len(phones))
+    with _db(db_path) as con:
+        rows = con.execute(
+            f"SELECT phone FROM auto_send_recipient_log WHERE send_date = ? AND phone IN ({marks})",
+            (str(date_str), *phones),
+        ).fetchall()
+    return {r[0] for r in rows}
+
+def mark_sent_today_for_recipients(db_path: Path, date_str: str, phones, ts_iso: str):
+    """Record a send to several recipients in one transaction."""
+    rows = [(str(date_str), str(p).strip(), str(ts_iso)) for p in phones if str(p).strip()]
+    if not rows:
+        return
+    with _tx(db_path) as con:
+        con.executemany(
+            "INSERT OR REPLACE INTO auto_send_recipient_log(send_date, phone, sent_at) VALUES (?, ?, ?)",
+            rows,
+        )
 
 
 # ------------------ CSV SEED ------------------
@@ -406,29 +937,25 @@ def seed_learners_from_csv_if_empty(db_path: Path, csv_path: str):
     CSV required: Name, Surname, Barcode
     Optional: Grade, Area, Date Of Birth
     """
-    existing = get_learners_df(db_path)
-    if not existing.empty:
+    with _db(db_path) as con:
+        (has_learners,) = con.execute("SELECT EXISTS(SELECT 1 FROM learners)").fetchone()
+    if has_learners:
         return
 
     p = Path(csv_path)
     if not p.exists():
         return
 
-    csv_df = pd.read_csv(p).fillna("").astype(str)
+    # dtype=str: no numeric inference, so barcodes never come back as "123.0";
+    # keep_default_na=False: blank cells arrive as "" (no fillna pass)
+    csv_df = pd.read_csv(p, dtype=str, keep_default_na=False)
     csv_df.columns = [c.strip() for c in csv_df.columns]
 
-    # Accept 'Date_Of_Birth' from CSV too
-    if "Date_Of_Birth" in csv_df.columns and "Date Of Birth" not in csv_df.columns:
-        csv_df = csv_df.rename(columns={"Date_Of_Birth": "Date Of Birth"})
-
     required = ["Name", "Surname", "Barcode"]
     if not all(c in csv_df.columns for c in required):
         return
 
-    for c in ["Grade", "Area", "Date Of Birth"]:
-        if c not in csv_df.columns:
-            csv_df[c] = ""
-
-    csv_df = csv_df[["Barcode", "Name", "Surname", "Grade", "Area", "Date Of Birth"]]
+    # Optional columns and DOB spellings (Date_Of_Birth, DOB, ...) are handled
+    # by _normalize_learner_columns inside replace_learners_from_df
     replace_learners_from_df(db_path, csv_df)
 